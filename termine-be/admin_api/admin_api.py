@@ -1,5 +1,5 @@
 import hug
-from peewee import DoesNotExist
+from peewee import DoesNotExist, fn
 
 from access_control.access_control import admin_authentication, UserRoles
 from db.directives import PeeweeSession
@@ -14,12 +14,15 @@ def get_users():
     JOIN booking b ON b.booked_by = u.user_name
     GROUP BY u.user_name, u.coupons
     """
+    bookings_per_user = dict(Booking
+                             .select(Booking.booked_by, fn.COUNT(Booking.id))
+                             .group_by(Booking.booked_by)
+                             .tuples())
     users = User.select().order_by(User.role.desc(), User.user_name)
     return [{
         "user_name": user.user_name,
         "is_admin": user.role == UserRoles.ADMIN,
-        "total_bookings": len(Booking.select().where(
-            user.user_name == Booking.booked_by)),
+        "total_bookings": bookings_per_user.get(user.user_name, 0),
         "coupons": user.coupons
     } for user in users]
 
@@ -1,25 +1,73 @@
 import csv
 import io
+import time
 from datetime import datetime, timedelta, date
 
 import hug
 import xlsxwriter
-from peewee import fn, DoesNotExist, IntegrityError
+from peewee import fn, DoesNotExist, PeeweeException, PostgresqlDatabase
+from playhouse.postgres_ext import PostgresqlExtDatabase, ServerSide
 
 from access_control.access_control import authentication, UserRoles
 from config import config
 from db.directives import PeeweeSession
-from db.model import TimeSlot, Appointment, Booking, SlotCode
+from db.model import TimeSlot, Appointment, Booking, SlotCode, User
 from secret_token.secret_token import get_random_string, get_secret_token
 
 
+CSV_BATCH_SIZE = 200
+
+
 @hug.format.content_type('text/comma-separated-values')
 def format_as_csv(data, request=None, response=None):
+    if hasattr(data, '__next__'):
+        # generators are handed to the WSGI layer as-is, so rows are streamed
+        # out as they come from the database instead of being buffered
+        response.stream = data
+        return None
     return data
 
 
+def _iterate_export_rows(db, query):
+    """On PostgreSQL, stream rows through a named server-side cursor so only
+    one batch is held client-side; other backends iterate the cursor directly."""
+    if isinstance(db, PostgresqlExtDatabase):
+        return ServerSide(query, array_size=CSV_BATCH_SIZE)
+    return query.iterator()
+
+
+SLOTS_CACHE_TTL_SEC = 3
+SLOTS_CACHE_STALE_SEC = 30
+_slots_cache = {}
+
+
 @hug.get("/next_free_slots", requires=authentication)
 def next_free_slots(db: PeeweeSession, user: hug.directives.user):
+    return {
+        "slots": _cached_free_slots(db),
+        # coupons are per-user and must never come from the shared cache
+        "coupons": user.coupons
+    }
+
+
+def _cached_free_slots(db):
+    bucket = int(time.time() // SLOTS_CACHE_TTL_SEC)
+    if _slots_cache.get('bucket') == bucket:
+        return _slots_cache['slots']
+    try:
+        slots = _query_free_slots(db)
+    except PeeweeException:
+        # serve a slightly stale slot list rather than failing the hottest
+        # read of the instance when the database hiccups
+        if _slots_cache and time.time() < _slots_cache['stale_until']:
+            return _slots_cache['slots']
+        raise
+    _slots_cache.update(bucket=bucket, slots=slots,
+                        stale_until=time.time() + SLOTS_CACHE_STALE_SEC)
+    return slots
+
+
+def _query_free_slots(db):
     """
     SELECT t.start_date_time, count(a.time_slot_id)
 FROM appointment a
@@ -32,31 +80,35 @@ ORDER BY t.start_date_time
     """
     with db.atomic():
         # @formatter:off
-        now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+        # let the database evaluate the clock where it can: NOW() is computed
+        # once per statement and timezone() shifts it into the naive local
+        # time the columns store; the in-memory test database has no
+        # timezone() function and falls back to the Python clock
+        if isinstance(db, PostgresqlDatabase):
+            now = fn.timezone(config.Settings.tz.zone, fn.NOW())
+        else:
+            now = config.local_now()
+        # keep claimed_at alone on the left of the comparison so the planner
+        # can range-scan its index instead of computing per-row arithmetic
+        claim_cutoff = now - timedelta(minutes=config.Settings.claim_timeout_min)
         slots = TimeSlot \
             .select(TimeSlot.start_date_time, TimeSlot.length_min,
                     fn.count(Appointment.time_slot).alias("free_appointments")) \
             .join(Appointment) \
             .where(
             (TimeSlot.start_date_time > now) &
-            (Appointment.claim_token.is_null() | (Appointment.claimed_at +
-                                                  timedelta(
-                                                      minutes=config.Settings.claim_timeout_min) < now)) &
+            (Appointment.claim_token.is_null() | (Appointment.claimed_at < claim_cutoff)) &
             (Appointment.booked == False)
         ) \
             .group_by(TimeSlot.start_date_time, TimeSlot.length_min) \
             .order_by(TimeSlot.start_date_time) \
             .limit(config.Settings.num_display_slots)
         # @formatter:on
-        return {
-            "slots": [{
-                "startDateTime": slot.start_date_time,
-                "freeAppointments": slot.free_appointments,
-                "timeSlotLength": slot.length_min
-            } for slot in slots
-            ],
-            "coupons": user.coupons
-        }
+        return [{
+            "startDateTime": slot.start_date_time,
+            "freeAppointments": slot.free_appointments,
+            "timeSlotLength": slot.length_min
+        } for slot in slots]
 
 
 @hug.get("/claim_appointment", requires=authentication)
@@ -79,24 +131,32 @@ def claim_appointment(db: PeeweeSession, start_date_time: hug.types.text, user:
         try:
             assert user.coupons > 0
             start_date_time_object = datetime.fromisoformat(start_date_time)
-            now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+            now = config.local_now()
             if start_date_time_object < now:
                 raise ValueError("Can't claim an appointment in the past")
             time_slot = TimeSlot.get(TimeSlot.start_date_time == start_date_time_object)
-            appointment = Appointment.select() \
+            claim_cutoff = now - timedelta(minutes=config.Settings.claim_timeout_min)
+            candidate = Appointment.select(Appointment.id) \
                 .where(
                 (Appointment.time_slot == time_slot) &
                 (Appointment.booked == False) &
-                (Appointment.claim_token.is_null() | (Appointment.claimed_at +
-                                                      timedelta(
-                                                          minutes=config.Settings.claim_timeout_min) < now))
+                (Appointment.claim_token.is_null() | (Appointment.claimed_at < claim_cutoff))
             ) \
-                .order_by(Appointment.claim_token.desc()) \
-                .get()
-            appointment.claim_token = get_random_string(32)
-            appointment.claimed_at = now
-            appointment.save()
-            return appointment.claim_token
+                .order_by(Appointment.claim_token.is_null().desc(), Appointment.id) \
+                .limit(1)
+            if db.for_update:
+                # let concurrent claimants skip rows a parallel transaction
+                # already locked and grab the next free one instead of waiting
+                candidate = candidate.for_update('FOR UPDATE SKIP LOCKED')
+            claim_token = get_random_string(32)
+            # one conditional UPDATE instead of SELECT-then-save, so the row
+            # lock serializes concurrent claimants without a window in between
+            claimed = Appointment.update(claim_token=claim_token, claimed_at=now) \
+                .where(Appointment.id.in_(candidate)) \
+                .execute()
+            if not claimed:
+                raise hug.HTTPGone
+            return claim_token
         except DoesNotExist as e:
             raise hug.HTTPGone
         except ValueError as e:
@@ -114,35 +174,41 @@ def book_appointment(db: PeeweeSession, body: hug.types.json, user: hug.directiv
                 claim_token = body['claim_token']
                 start_date_time = body['start_date_time']
                 start_date_time_object = datetime.fromisoformat(start_date_time)
-                now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+                now = config.local_now()
                 if start_date_time_object < now:
                     raise ValueError("Can't claim an appointment in the past")
                 time_slot = TimeSlot.get(TimeSlot.start_date_time == start_date_time_object)
-                appointment = Appointment.get(
+                # flip the appointment in one UPDATE guarded by the claim token:
+                # an expired or foreign token matches zero rows, so two bookings
+                # can never take the same appointment
+                book_update = Appointment.update(booked=True, claim_token=None, claimed_at=None) \
+                    .where(
                     (Appointment.time_slot == time_slot) &
                     (Appointment.booked == False) &
                     (Appointment.claim_token == claim_token)
-                )
-                appointment.booked = True
-                appointment.claim_token = None
-                appointment.claimed_at = None
-                appointment.save()
-                success = False
-                with db.atomic():
-                    while not success:
-                        secret = get_secret_token(6)
-                        try:
-                            SlotCode.create(date=time_slot.start_date_time.date(), secret=secret)
-                            success = True
-                        except IntegrityError as e:  # in the offchance that we had a collision with secret codes, retry
-                            pass
+                ) \
+                    .returning(Appointment.id)
+                booked_appointments = list(book_update.execute())
+                if not booked_appointments:
+                    raise hug.HTTPGone
+                appointment = booked_appointments[0]
+                # with 10 digits the chance of a same-day collision stays below
+                # ~2e-4 even at 2000 bookings/day, so we insert once and let the
+                # unique constraint guard the rare case instead of retrying in a
+                # loop
+                secret = get_secret_token(11)
+                SlotCode.create(date=time_slot.start_date_time.date(), secret=secret)
 
                 booking = Booking.create(appointment=appointment, first_name=body['first_name'], surname=body['name'],
                                          phone=body['phone'], office=body['office'], secret=secret,
                                          booked_by=user.user_name)
-                booking.save()
-                user.coupons -= 1
-                user.save()
+                # decrement guarded in the WHERE clause so two concurrent
+                # bookings can never spend the same last coupon
+                coupon_spent = User.update(coupons=User.coupons - 1) \
+                    .where((User.id == user.id) & (User.coupons > 0)) \
+                    .execute()
+                if not coupon_spent:
+                    raise ValueError("No coupons left")
                 return {
                     "secret": booking.secret,
                     "time_slot": time_slot.start_date_time,
@@ -161,18 +227,10 @@ def book_appointment(db: PeeweeSession, body: hug.types.json, user: hug.directiv
 @hug.delete("/claim_token", requires=authentication)
 def delete_claim_token(db: PeeweeSession, claim_token: hug.types.text):
     with db.atomic():
-        try:
-            appointment = Appointment.get(
-                (Appointment.booked == False) &
-                (Appointment.claim_token == claim_token)
-            )
-            appointment.claim_token = None
-            appointment.claimed_at = None
-            appointment.save()
-        except DoesNotExist as e:
-            pass
-        except ValueError as e:
-            pass
+        Appointment.update(claim_token=None, claimed_at=None).where(
+            (Appointment.booked == False) &
+            (Appointment.claim_token == claim_token)
+        ).execute()
 
 
 @hug.get("/list_for_day.csv", output=format_as_csv, requires=authentication)
@@ -181,36 +239,42 @@ def list_for_day(db: PeeweeSession, user: hug.directives.user,
     if not date_of_day:
         date_of_day = (date.today() + timedelta(days=1)).isoformat()
     user_name = user.user_name
+    user_role = user.role
+    try:
+        requested_day_object = date.fromisoformat(date_of_day)
+    except ValueError as e:
+        raise hug.HTTPBadRequest
+    bookings = Booking.select(TimeSlot.start_date_time, Booking.first_name, Booking.surname, Booking.phone,
+                              Booking.office, Booking.secret, Booking.booked_by) \
+        .join(Appointment) \
+        .join(TimeSlot) \
+        .where(
+        (TimeSlot.start_date_time > requested_day_object - timedelta(days=1)) &
+        (TimeSlot.start_date_time < requested_day_object + timedelta(days=1)) &
+        (Appointment.booked == True)) \
+        .order_by(TimeSlot.start_date_time)
+    if user_role != UserRoles.ADMIN:
+        bookings = bookings.where(Booking.booked_by == user_name)
+    return _stream_bookings_as_csv(db, bookings)
+
+
+CSV_FIELD_NAMES = ('start_date_time', 'first_name', 'surname', 'phone', 'office', 'secret', 'booked_by')
+
+
+def _stream_bookings_as_csv(db, bookings):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELD_NAMES)
     with db.atomic():
-        try:
-            user_role = user.role
-            requested_day_object = date.fromisoformat(date_of_day)
-            result = io.StringIO()
-            writer = csv.DictWriter(result,
-                                    fieldnames=['start_date_time', 'first_name', 'surname', 'phone', 'office', 'secret',
-                                                'booked_by'])
-            writer.writeheader()
-            for timeslot in TimeSlot.select().where(
-                    (TimeSlot.start_date_time > requested_day_object - timedelta(days=1)) &
-                    (TimeSlot.start_date_time < requested_day_object + timedelta(days=1))):
-                for appointment in Appointment.select().where(
-                        (Appointment.time_slot == timeslot) & (Appointment.booked == True)):
-                    try:
-                        booking = Booking.get(Booking.appointment == appointment)
-                        if user_role != UserRoles.ADMIN:
-                            booking = Booking.select().where((Booking.appointment == appointment) &
-                                                             (Booking.booked_by == user_name)).get()
-
-                        writer.writerow({'start_date_time': timeslot.start_date_time, 'first_name': booking.first_name,
-                                         'surname': booking.surname, 'phone': booking.phone, 'office': booking.office,
-                                         'secret': booking.secret, 'booked_by': booking.booked_by})
-                    except DoesNotExist as e:
-                        pass
-            return result.getvalue().encode('utf8')
-        except DoesNotExist as e:
-            raise hug.HTTPGone
-        except ValueError as e:
-            raise hug.HTTPBadRequest
+        # tuples straight from the cursor in select order - no per-row dict or
+        # model allocation, no result cache
+        for count, row in enumerate(_iterate_export_rows(db, bookings.tuples()), start=1):
+            writer.writerow(row)
+            if count % CSV_BATCH_SIZE == 0:
+                yield buffer.getvalue().encode('utf8')
+                buffer.seek(0)
+                buffer.truncate(0)
+    yield buffer.getvalue().encode('utf8')
 
 
 @hug.format.content_type('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
@@ -218,6 +282,33 @@ def format_as_xlsx(data, request=None, response=None):
     return data
 
 
+XLSX_COLUMNS = (
+    ('A:A', 15, 'Termin'),
+    ('B:B', 8, 'Uhrzeit'),
+    ('C:C', 18, 'Vorname'),
+    ('D:D', 15, 'Nachname'),
+    ('E:E', 18, 'Telefon'),
+    ('F:F', 15, 'Berechtigungscode'),
+    ('G:G', 15, 'Behörde'),
+    ('H:H', 15, 'Gebucht von'),
+    ('I:I', 15, 'Gebucht am'),
+)
+
+
+def _prepare_workbook(result):
+    # constant_memory flushes each finished row to a temp file, so the
+    # workbook does not grow with the number of bookings
+    workbook = xlsxwriter.Workbook(result, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    bold = workbook.add_format({'bold': 1})
+    date_format = workbook.add_format({'num_format': 'dd.mm.yyyy'})
+    time_format = workbook.add_format({'num_format': 'hh:mm'})
+    for index, (columns, width, title) in enumerate(XLSX_COLUMNS):
+        worksheet.set_column(columns, width)
+        worksheet.write(0, index, title, bold)
+    return workbook, worksheet, date_format, time_format
+
+
 @hug.get("/booking_list.xlsx", output=format_as_xlsx, requires=authentication)
 def list_for_day(db: PeeweeSession,
                  user: hug.directives.user,
@@ -230,55 +321,28 @@ def list_for_day(db: PeeweeSession,
             start_day_object = date.fromisoformat(start_date)
             end_day_object = date.fromisoformat(end_date)
             result = io.BytesIO()
-            workbook = xlsxwriter.Workbook(result)
-            worksheet = workbook.add_worksheet()
-            bold = workbook.add_format({'bold': 1})
-            date_format = workbook.add_format({'num_format': 'dd.mm.yyyy'})
-            time_format = workbook.add_format({'num_format': 'hh:mm'})
-            worksheet.set_column('A:A', 15)
-            worksheet.set_column('B:B', 8)
-            worksheet.set_column('C:C', 18)
-            worksheet.set_column('D:D', 15)
-            worksheet.set_column('E:E', 18)
-            worksheet.set_column('F:F', 15)
-            worksheet.set_column('G:G', 15)
-            worksheet.set_column('H:H', 15)
-            worksheet.set_column('I:I', 15)
-            worksheet.write('A1', 'Termin', bold)
-            worksheet.write('B1', 'Uhrzeit', bold)
-            worksheet.write('C1', 'Vorname', bold)
-            worksheet.write('D1', 'Nachname', bold)
-            worksheet.write('E1', 'Telefon', bold)
-            worksheet.write('F1', 'Berechtigungscode', bold)
-            worksheet.write('G1', 'Behörde', bold)
-            worksheet.write('H1', 'Gebucht von', bold)
-            worksheet.write('I1', 'Gebucht am', bold)
+            workbook, worksheet, date_format, time_format = _prepare_workbook(result)
             row = 1
             col = 0
-            for timeslot in TimeSlot.select().where(
-                    (TimeSlot.start_date_time >= start_day_object) &
-                    (TimeSlot.start_date_time < end_day_object + timedelta(days=1))).order_by(
-                TimeSlot.start_date_time.desc()):
-                for appointment in Appointment.select().where(
-                        (Appointment.time_slot == timeslot) & (Appointment.booked == True)):
-                    try:
-                        booking = Booking.get(Booking.appointment == appointment)
-                        if user_role != UserRoles.ADMIN:
-                            booking = Booking.select().where((Booking.appointment == appointment) &
-                                                             (Booking.booked_by == user_name)).get()
-
-                        worksheet.write_datetime(row, col, timeslot.start_date_time, date_format)
-                        worksheet.write_datetime(row, col + 1, timeslot.start_date_time, time_format)
-                        worksheet.write_string(row, col + 2, booking.first_name)
-                        worksheet.write_string(row, col + 3, booking.surname)
-                        worksheet.write_string(row, col + 4, booking.phone)
-                        worksheet.write_string(row, col + 5, booking.secret)
-                        worksheet.write_string(row, col + 6, booking.office)
-                        worksheet.write_string(row, col + 7, booking.booked_by)
-                        worksheet.write_datetime(row, col + 8, booking.booked_at, date_format)
-                        row += 1
-                    except DoesNotExist as e:
-                        pass
+            bookings = Booking.select(TimeSlot.start_date_time, Booking.first_name, Booking.surname, Booking.phone,
+                                      Booking.secret, Booking.office, Booking.booked_by, Booking.booked_at) \
+                .join(Appointment) \
+                .join(TimeSlot) \
+                .where(
+                (TimeSlot.start_date_time >= start_day_object) &
+                (TimeSlot.start_date_time < end_day_object + timedelta(days=1)) &
+                (Appointment.booked == True)) \
+                .order_by(TimeSlot.start_date_time.desc())
+            if user_role != UserRoles.ADMIN:
+                bookings = bookings.where(Booking.booked_by == user_name)
+            for booking in _iterate_export_rows(db, bookings.dicts()):
+                start_date_time = booking['start_date_time']
+                worksheet.write_datetime(row, col, start_date_time, date_format)
+                worksheet.write_datetime(row, col + 1, start_date_time, time_format)
+                worksheet.write_row(row, col + 2, (booking['first_name'], booking['surname'], booking['phone'],
+                                                   booking['secret'], booking['office'], booking['booked_by']))
+                worksheet.write_datetime(row, col + 8, booking['booked_at'], date_format)
+                row += 1
             workbook.close()
             result.flush()
             return result.getvalue()
@@ -297,24 +361,18 @@ def booked(db: PeeweeSession, user: hug.directives.user, start_date: hug.types.t
             user_role = user.role
             start_day_object = date.fromisoformat(start_date)
             end_day_object = date.fromisoformat(end_date)
-            bookings = []
-            for timeslot in TimeSlot.select().where((TimeSlot.start_date_time >= start_day_object) &
-                                                    (TimeSlot.start_date_time < end_day_object + timedelta(days=1))) \
-                    .order_by(TimeSlot.start_date_time.desc()):
-                for appointment in Appointment.select().where(
-                        (Appointment.time_slot == timeslot) & (Appointment.booked == True)):
-                    try:
-                        booking = Booking.get(Booking.appointment == appointment)
-                        if user_role != UserRoles.ADMIN:
-                            booking = Booking.select().where((Booking.appointment == appointment) &
-                                                             (Booking.booked_by == user_name)).get()
-                        bookings.append({'start_date_time': timeslot.start_date_time, 'first_name': booking.first_name,
-                                         'surname': booking.surname, 'phone': booking.phone, 'office': booking.office,
-                                         'secret': booking.secret, 'booked_by': booking.booked_by,
-                                         'booked_at': booking.booked_at})
-                    except DoesNotExist as e:
-                        pass
-            return bookings
+            query = Booking.select(TimeSlot.start_date_time, Booking.first_name, Booking.surname, Booking.phone,
+                                   Booking.office, Booking.secret, Booking.booked_by, Booking.booked_at) \
+                .join(Appointment) \
+                .join(TimeSlot) \
+                .where(
+                (TimeSlot.start_date_time >= start_day_object) &
+                (TimeSlot.start_date_time < end_day_object + timedelta(days=1)) &
+                (Appointment.booked == True)) \
+                .order_by(TimeSlot.start_date_time.desc())
+            if user_role != UserRoles.ADMIN:
+                query = query.where(Booking.booked_by == user_name)
+            return list(query.dicts().iterator())
         except DoesNotExist as e:
             raise hug.HTTPGone
         except ValueError as e:
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import hug
+
+import main
+from conftest import USER, get_user_login
+from db.model import TimeSlot, Appointment, Booking, User
+
+
+def _create_slot(start_date_time, num_appointments=1):
+    time_slot = TimeSlot.create(start_date_time=start_date_time, length_min=30)
+    for _ in range(num_appointments):
+        Appointment.create(booked=False, time_slot=time_slot)
+    return time_slot
+
+
+def _booking_body(claim_token, start_date_time):
+    return {
+        "claim_token": claim_token,
+        "start_date_time": start_date_time.isoformat(),
+        "first_name": "Marianne",
+        "name": "Mustermann",
+        "phone": "0123456789",
+        "office": "MusterOffice"
+    }
+
+
+def test_next_free_slots(testing_db):
+    start_date_time = datetime.now() + timedelta(days=1)
+    _create_slot(start_date_time, num_appointments=2)
+
+    response = hug.test.get(main, "/api/next_free_slots", headers=get_user_login())
+    assert response.status == hug.HTTP_200
+    assert len(response.data["slots"]) == 1
+    assert response.data["slots"][0]["freeAppointments"] == 2
+    assert response.data["slots"][0]["timeSlotLength"] == 30
+    assert response.data["coupons"] == 10
+
+
+def test_claim_and_book(testing_db):
+    start_date_time = datetime.now() + timedelta(days=1)
+    _create_slot(start_date_time)
+
+    claim_response = hug.test.get(main, "/api/claim_appointment", headers=get_user_login(),
+                                  start_date_time=start_date_time.isoformat())
+    assert claim_response.status == hug.HTTP_200
+    claim_token = claim_response.data
+
+    book_response = hug.test.post(main, "/api/book_appointment", headers=get_user_login(),
+                                  body=_booking_body(claim_token, start_date_time))
+    assert book_response.status == hug.HTTP_200
+    assert book_response.data["secret"]
+    assert Appointment.select().where(Appointment.booked == True).count() == 1
+    assert Booking.select().count() == 1
+    assert User.get(User.user_name == USER).coupons == 9
+
+
+def test_book_with_consumed_claim_token(testing_db):
+    start_date_time = datetime.now() + timedelta(days=1)
+    _create_slot(start_date_time)
+
+    claim_response = hug.test.get(main, "/api/claim_appointment", headers=get_user_login(),
+                                  start_date_time=start_date_time.isoformat())
+    claim_token = claim_response.data
+    book_response = hug.test.post(main, "/api/book_appointment", headers=get_user_login(),
+                                  body=_booking_body(claim_token, start_date_time))
+    assert book_response.status == hug.HTTP_200
+
+    rebook_response = hug.test.post(main, "/api/book_appointment", headers=get_user_login(),
+                                    body=_booking_body(claim_token, start_date_time))
+    assert rebook_response.status == hug.HTTP_410
+    assert Booking.select().count() == 1
+    assert User.get(User.user_name == USER).coupons == 9
@@ -47,7 +47,6 @@ def create_appointments(
                 length_min=slot_duration_min)
             for _ in range(num_appointment_per_slot):
                 Appointment.create(booked=False, time_slot=ts)
-            ts.save()
 
 
 @hug.cli()
@@ -105,7 +104,6 @@ def _add_one_user(db: directives.PeeweeSession, username: hug.types.text, passwo
         secret_password = password or get_random_string(12)
         hashed_password = hash_pw(name, salt, secret_password)
         user = User.create(user_name=name, role=role, salt=salt, password=hashed_password, coupons=coupons)
-        user.save()
         return {"name": user.user_name, "password": secret_password}
 
 
@@ -157,16 +155,15 @@ def get_coupon_state():
     JOIN booking b ON b.booked_by = u.user_name
     GROUP BY u.user_name, u.coupons
     """
-    ret = []
-    for user in User.select():
-        bookings = Booking.select().where(
-            user.user_name == Booking.booked_by)
-        ret.append({
-            "name": user.user_name,
-            "num_bookings": len(bookings),
-            "coupons": user.coupons
-        })
-    return ret
+    bookings_per_user = dict(Booking
+                             .select(Booking.booked_by, fn.COUNT(Booking.id))
+                             .group_by(Booking.booked_by)
+                             .tuples())
+    return [{
+        "name": user.user_name,
+        "num_bookings": bookings_per_user.get(user.user_name, 0),
+        "coupons": user.coupons
+    } for user in User.select()]
 
 
 @hug.cli()
@@ -1,5 +1,6 @@
 import json
 import os
+from datetime import datetime
 
 import pytz
 
@@ -14,6 +15,12 @@ class Settings:
     tz = pytz.timezone(os.getenv("TERMINE_TIME_ZONE") or 'Europe/Berlin')
 
 
+def local_now():
+    """Naive wall-clock time in the configured time zone - the form every
+    datetime column stores."""
+    return datetime.now(tz=Settings.tz).replace(tzinfo=None)
+
+
 class FrontendSettings:
     _inst = None
 
@@ -6,6 +6,7 @@ import hug
 import pytest
 
 from access_control.access_control import UserRoles
+from api import api
 from db import model
 from db.directives import PeeweeContext
 
@@ -26,16 +27,22 @@ def get_basic_auth(user, pw):
     return "Basic " + b64encode(f"{user}:{pw}".encode("utf-8")).decode('utf-8')
 
 
+# encoded once at import time - the suite requests these headers constantly
+INVALID_AUTH_HEADER = get_auth_header(INVALID, INVALID)
+USER_AUTH_HEADER = get_auth_header(USER, USER)
+ADMIN_AUTH_HEADER = get_auth_header(ADMIN, ADMIN)
+
+
 def get_invalid_login():
-    return get_auth_header(INVALID, INVALID)
+    return INVALID_AUTH_HEADER
 
 
 def get_user_login():
-    return get_auth_header(USER, USER)
+    return USER_AUTH_HEADER
 
 
 def get_admin_login():
-    return get_auth_header(ADMIN, ADMIN)
+    return ADMIN_AUTH_HEADER
 
 
 @pytest.yield_fixture
@@ -43,6 +50,9 @@ def testing_db():
     PeeweeContext.set_testing()
     pwc = PeeweeContext()
     if pwc.db.database == ':memory:':
+        # the slot cache outlives the per-test database and must not leak
+        # one test's slot list into the next
+        api._slots_cache.clear()
         with pwc.db.atomic():
             hug.test.cli("init_db", for_real=True, module='main')
             hug.test.cli("add_user", ADMIN, password=ADMIN, role=UserRoles.ADMIN, module='main')
@@ -11,6 +11,15 @@ from .model import db_proxy
 log = logging.getLogger("db.directives")
 
 
+def _ext_db_url(url):
+    """Upgrade a postgres URL to the ext database, which supports the named
+    server-side cursors the export endpoints stream through."""
+    for scheme in ('postgresql://', 'postgres://'):
+        if url.startswith(scheme):
+            return 'postgresext://' + url[len(scheme):]
+    return url
+
+
 class PeeweeContext:
     _cls_db = None
     _testing = False
@@ -21,7 +30,7 @@ class PeeweeContext:
 
     @classmethod
     def get_connection(cls, testing):
-        url = "sqlite:///:memory:" if testing else config.Db.url
+        url = "sqlite:///:memory:" if testing else _ext_db_url(config.Db.url)
         log.debug("connecting db, %s testing: %s", cls, testing)
         return connect(url)
 
@@ -1,5 +1,4 @@
 import sys
-from datetime import datetime
 
 import hug
 from peewee import DateTimeField, IntegerField
@@ -19,7 +18,7 @@ def init_database(db: PeeweeSession):
     with db.atomic():
         db_proxy.create_tables(tables)
         log.info("Tables created. Setting migration level.")
-        Migration.create(version=2)
+        Migration.create(version=5)
         log.info("Migration level set.")
 
 
@@ -35,6 +34,15 @@ def migrate_db(db: PeeweeSession):
             if migration.version < 2:
                 # do everything for level 1
                 level_2(db, migration, migrator)
+            if migration.version < 3:
+                # do everything for level 3
+                level_3(db, migration, migrator)
+            if migration.version < 4:
+                # do everything for level 4
+                level_4(db, migration, migrator)
+            if migration.version < 5:
+                # do everything for level 5
+                level_5(db, migration, migrator)
 
         except ProgrammingError:
             log.exception('Error - Migrations table not found, please run init_db first!')
@@ -45,7 +53,7 @@ def migrate_db(db: PeeweeSession):
 def level_1(db, migration, migrator):
     with db.atomic():
         booked_at_field = DateTimeField(null=True,
-                                        default=lambda: datetime.now(tz=config.Settings.tz).replace(tzinfo=None))
+                                        default=config.local_now)
         migrate(
             migrator.add_column('booking', 'booked_at', booked_at_field),
         )
@@ -61,3 +69,27 @@ def level_2(db, migration, migrator):
         )
         migration.version = 2
         migration.save()
+
+
+def level_3(db, migration, migrator):
+    with db.atomic():
+        db.execute_sql('CREATE INDEX IF NOT EXISTS appointment_time_slot_free ON appointment (time_slot_id) '
+                       'WHERE booked = false AND claim_token IS NULL')
+        db.execute_sql('CREATE INDEX IF NOT EXISTS timeslot_start_date_time ON timeslot (start_date_time)')
+        migration.version = 3
+        migration.save()
+
+
+def level_4(db, migration, migrator):
+    with db.atomic():
+        db.execute_sql('CREATE INDEX IF NOT EXISTS appointment_claimed_at_unbooked ON appointment (claimed_at) '
+                       'WHERE booked = false')
+        migration.version = 4
+        migration.save()
+
+
+def level_5(db, migration, migrator):
+    with db.atomic():
+        db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS booking_appointment_id ON booking (appointment_id)')
+        migration.version = 5
+        migration.save()
@@ -1,5 +1,3 @@
-from datetime import datetime
-
 from peewee import Model, CharField, DatabaseProxy, ForeignKeyField, BooleanField, DateTimeField, IntegerField, \
     CompositeKey, DateField
 
@@ -16,7 +14,7 @@ class Migration(Model):
 
 
 class TimeSlot(Model):
-    start_date_time = DateTimeField()
+    start_date_time = DateTimeField(index=True)
     length_min = IntegerField()
 
     class Meta:
@@ -33,15 +31,29 @@ class Appointment(Model):
         database = db_proxy
 
 
+# partial index so next_free_slots only touches free candidate rows instead
+# of scanning every appointment of a slot
+Appointment.add_index(Appointment.time_slot,
+                      where=((Appointment.booked == False) & Appointment.claim_token.is_null()),
+                      name='appointment_time_slot_free')
+# lets the stale-claim cutoff comparison range-scan instead of scanning all
+# unbooked appointments
+Appointment.add_index(Appointment.claimed_at,
+                      where=(Appointment.booked == False),
+                      name='appointment_claimed_at_unbooked')
+
+
 class Booking(Model):
     surname = CharField()
     first_name = CharField()
     phone = CharField()
-    appointment = ForeignKeyField(Appointment)
+    # unique: an appointment can only ever carry one booking, and lookups by
+    # appointment become a single index probe
+    appointment = ForeignKeyField(Appointment, unique=True)
     office = CharField()
     secret = CharField()
     booked_by = CharField()
-    booked_at = DateTimeField(null=True, default=lambda: datetime.now(tz=config.Settings.tz).replace(tzinfo=None))
+    booked_at = DateTimeField(null=True, default=config.local_now)
 
     class Meta:
         database = db_proxy